@@ -5,18 +5,30 @@ Bank statement audit: cross-reference bank transactions with Paperless-ngx docum
 Usage: python audit.py YYYY MM
 """
 
+import asyncio
+import functools
+import hashlib
+import io
 import json
+import math
 import re
 import sys
-import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
 from pathlib import Path
 
+import aiohttp
 import openai
 import openpyxl
+import orjson
 import requests
 import xlrd
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 
 load_dotenv()
@@ -27,27 +39,108 @@ OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 BANK_STATEMENT_TAG_ID = int(os.environ["BANK_STATEMENT_TAG_ID"])
 WRITE_NOTES = os.environ.get("WRITE_NOTES", "false").lower() in ("true", "1", "yes")
 
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "3600"))
+
 CACHE_DIR = Path(__file__).parent / "cache"
 CACHE_DIR.mkdir(exist_ok=True)
+SEARCH_CACHE_DIR = CACHE_DIR / "search"
+SEARCH_CACHE_DIR.mkdir(exist_ok=True)
+OPENAI_CACHE_DIR = CACHE_DIR / "openai"
+OPENAI_CACHE_DIR.mkdir(exist_ok=True)
 
 HEADERS = {"Authorization": f"Token {PAPERLESS_TOKEN}"}
 
+# Max concurrent Paperless requests, across all statement workers
+PAPERLESS_CONCURRENCY = 16
+
+# Max bank statements processed in parallel
+STATEMENT_WORKERS = 4
+
+# Paperless responses worth retrying, with exponential backoff
+RETRY_STATUSES = (502, 503, 504)
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5
+
+# Max statements extracted via OpenAI in parallel, to stay within rate limits
+OPENAI_CONCURRENCY = 5
+
+# Shared keep-alive session for synchronous Paperless requests
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+_adapter = HTTPAdapter(
+    pool_connections=PAPERLESS_CONCURRENCY,
+    pool_maxsize=PAPERLESS_CONCURRENCY,
+    max_retries=Retry(
+        total=RETRY_ATTEMPTS, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUSES
+    ),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
 
 # ── Paperless API ─────────────────────────────────────────────────────
 
 def paperless_get(endpoint, params=None):
-    resp = requests.get(f"{PAPERLESS_URL}{endpoint}", headers=HEADERS, params=params)
+    resp = SESSION.get(f"{PAPERLESS_URL}{endpoint}", params=params)
     resp.raise_for_status()
-    return resp.json()
-
-
-def get_statements(tag_id, year, month):
-    """Fetch bank statement documents for the given month."""
+    return orjson.loads(resp.content)
+
+
+def paperless_session():
+    """aiohttp session for Paperless requests, with auth headers and a bounded pool.
+
+    Each statement worker opens its own session, so the pool gets an equal
+    share of PAPERLESS_CONCURRENCY.
+    """
+    connector = aiohttp.TCPConnector(limit=max(1, PAPERLESS_CONCURRENCY // STATEMENT_WORKERS))
+    return aiohttp.ClientSession(headers=HEADERS, connector=connector)
+
+
+async def paperless_get_async(session, endpoint, params=None):
+    """GET a Paperless endpoint, retrying gateway errors like the sync SESSION does."""
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        try:
+            async with session.get(f"{PAPERLESS_URL}{endpoint}", params=params) as resp:
+                if resp.status in RETRY_STATUSES and attempt < RETRY_ATTEMPTS:
+                    await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+                    continue
+                resp.raise_for_status()
+                return orjson.loads(await resp.read())
+        except aiohttp.ClientConnectionError:
+            if attempt == RETRY_ATTEMPTS:
+                raise
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+
+async def paperless_get_all_async(session, endpoint, params, max_pages=None):
+    """Fetch every page of a list endpoint, up to max_pages; pages after the first are fetched concurrently."""
+    data = await paperless_get_async(session, endpoint, params)
+    results = data.get("results", [])
+    n_pages = math.ceil(data.get("count", 0) / params["page_size"])
+    if max_pages:
+        n_pages = min(n_pages, max_pages)
+    pages = await asyncio.gather(*[
+        paperless_get_async(session, endpoint, {**params, "page": page})
+        for page in range(2, n_pages + 1)
+    ])
+    for page_data in pages:
+        results.extend(page_data.get("results", []))
+    return results
+
+
+def month_bounds(year, month):
+    """Return (first day of the month, first day of the next month)."""
     first_day = date(year, month, 1)
     if month == 12:
         next_month = date(year + 1, 1, 1)
     else:
         next_month = date(year, month + 1, 1)
+    return first_day, next_month
+
+
+def get_statements(tag_id, year, month):
+    """Fetch bank statement documents for the given month."""
+    first_day, next_month = month_bounds(year, month)
 
     docs = []
     params = {
@@ -55,22 +148,30 @@ def get_statements(tag_id, year, month):
         "created__date__gte": first_day.isoformat(),
         "created__date__lt": next_month.isoformat(),
         "page_size": 100,
+        # Includes the OCR content, so statements need no separate detail request
+        "fields": "id,title,tags,content,created,original_file_name",
     }
     data = paperless_get("/api/documents/", params)
     docs.extend(data.get("results", []))
 
-    while data.get("next"):
-        data = requests.get(data["next"], headers=HEADERS).json()
-        docs.extend(data.get("results", []))
+    # Fetch the remaining pages in parallel now that the total count is known
+    n_pages = math.ceil(data.get("count", 0) / params["page_size"])
+    if n_pages > 1:
+        with ThreadPoolExecutor(max_workers=PAPERLESS_CONCURRENCY) as pool:
+            pages = pool.map(
+                lambda page: paperless_get("/api/documents/", {**params, "page": page}),
+                range(2, n_pages + 1),
+            )
+            for page_data in pages:
+                docs.extend(page_data.get("results", []))
 
     return docs
 
 
 def download_original(doc_id):
     """Download the original file from Paperless. Returns (bytes, filename)."""
-    resp = requests.get(
+    resp = SESSION.get(
         f"{PAPERLESS_URL}/api/documents/{doc_id}/download/",
-        headers=HEADERS,
         params={"original": "true"},
     )
     resp.raise_for_status()
@@ -84,23 +185,92 @@ def download_original(doc_id):
     return resp.content, filename
 
 
-def get_document_content(doc_id):
-    """Get the full text content of a document."""
-    doc = paperless_get(f"/api/documents/{doc_id}/")
-    return doc.get("content", "")
+_search_memo = {}
 
 
-def search_documents(query, date_from=None, date_to=None):
-    """Search Paperless for documents matching a query."""
-    params = {"query": query, "page_size": 10}
+def search_params(query, date_from=None, date_to=None, page_size=10):
+    """Query parameters of a Paperless document search, excluding bank statements."""
+    params = {"query": query, "tags__id__none": BANK_STATEMENT_TAG_ID, "page_size": page_size}
     if date_from:
         params["created__date__gte"] = date_from
     if date_to:
         params["created__date__lte"] = date_to
-    data = paperless_get("/api/documents/", params)
+    return params
+
+
+def cached_search(func):
+    """Cache search results in memory for the run and on disk for SEARCH_CACHE_TTL seconds."""
+    @functools.wraps(func)
+    async def wrapper(session, query, date_from=None, date_to=None, page_size=10, max_pages=1):
+        # Keyed on the exact request parameters, so any change to them invalidates old entries
+        key_src = json.dumps(
+            {"params": search_params(query, date_from, date_to, page_size), "max_pages": max_pages},
+            sort_keys=True,
+        )
+        key = hashlib.sha1(key_src.encode()).hexdigest()
+        if key in _search_memo:
+            return _search_memo[key]
+
+        path = SEARCH_CACHE_DIR / f"{key}.json"
+        results = None
+        if path.exists() and time.time() - path.stat().st_mtime < SEARCH_CACHE_TTL:
+            try:
+                results = orjson.loads(path.read_bytes())
+            except (OSError, orjson.JSONDecodeError):
+                results = None
+        if results is None:
+            results = await func(session, query, date_from, date_to, page_size, max_pages)
+            if SEARCH_CACHE_TTL > 0:
+                write_atomic(path, orjson.dumps(results))
+
+        _search_memo[key] = results
+        return results
+
+    return wrapper
+
+
+@cached_search
+async def search_documents(session, query, date_from=None, date_to=None, page_size=10, max_pages=1):
+    """Search Paperless for documents matching a query, excluding bank statements.
+
+    Returns up to max_pages pages of results.
+    """
+    params = search_params(query, date_from, date_to, page_size)
+    if max_pages > 1:
+        return await paperless_get_all_async(session, "/api/documents/", params, max_pages)
+    data = await paperless_get_async(session, "/api/documents/", params)
     return data.get("results", [])
 
 
+async def fetch_candidates(session, date_from, date_to, page_size=500):
+    """Fetch all non-statement documents created in the date range."""
+    if not (date_from and date_to):
+        raise ValueError("candidate fetch needs a bounded date range")
+    params = {
+        "tags__id__none": BANK_STATEMENT_TAG_ID,
+        "created__date__gte": date_from,
+        "created__date__lte": date_to,
+        "page_size": page_size,
+        "fields": "id,title,content,created",
+    }
+    return await paperless_get_all_async(session, "/api/documents/", params)
+
+
+# ── Transaction text ──────────────────────────────────────────────────
+
+# Dates in statements: 2025-01-03, 03.01.2025, 03/01/2025, optionally with a time
+_DATE_RE = re.compile(
+    r"(?:\b\d{4}-\d{2}-\d{2}\b|\b\d{2}[./]\d{2}[./]\d{4}\b)(?:[ T]\d{2}:\d{2}(?::\d{2})?)?"
+)
+# Any standalone number: 1 234,56, -45.5, 1200, 100 EUR
+_AMT_RE = re.compile(r"(?<!\w)-?\d[\d .,]*(?!\w)")
+
+
+def has_amount(text):
+    """Check for an amount in text; dates are stripped first, since 12.01.2025 would pass as one."""
+    return bool(_AMT_RE.search(_DATE_RE.sub("", text)))
+
+
 # ── XLS parsing ───────────────────────────────────────────────────────
 
 def parse_xls_to_text(file_bytes, filename):
@@ -109,39 +279,69 @@ def parse_xls_to_text(file_bytes, filename):
     if suffix not in (".xls", ".xlsx"):
         return None
 
-    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
-        f.write(file_bytes)
-        tmp_path = f.name
-
     try:
         if suffix == ".xls":
-            return _parse_xls_legacy(tmp_path)
+            return _parse_xls_legacy(file_bytes)
         else:
-            return _parse_xlsx(tmp_path)
+            return _parse_xlsx(file_bytes)
     except Exception:
         return None
-    finally:
-        Path(tmp_path).unlink(missing_ok=True)
 
 
-def _parse_xls_legacy(path):
+# Only the first rows of a sheet are inspected to decide whether it holds transactions
+SHEET_SCAN_ROWS = 20
+
+def _is_transaction_row(has_date, has_amount_cell, texts):
+    """Heuristic: a transaction row has both a date and an amount."""
+    text = " | ".join(texts)
+    return (has_date or bool(_DATE_RE.search(text))) and (has_amount_cell or has_amount(text))
+
+
+def _xls_sheet_has_transactions(sheet):
+    for row_idx in range(min(SHEET_SCAN_ROWS, sheet.nrows)):
+        types = sheet.row_types(row_idx)
+        values = sheet.row_values(row_idx)
+        texts = [v for t, v in zip(types, values) if t == xlrd.XL_CELL_TEXT]
+        if _is_transaction_row(xlrd.XL_CELL_DATE in types, xlrd.XL_CELL_NUMBER in types, texts):
+            return True
+    return False
+
+
+def _xlsx_sheet_has_transactions(sheet):
+    for row in sheet.iter_rows(max_row=SHEET_SCAN_ROWS, values_only=True):
+        has_date = any(isinstance(c, date) for c in row)
+        has_amount_cell = any(isinstance(c, (int, float)) and not isinstance(c, bool) for c in row)
+        texts = [c for c in row if isinstance(c, str)]
+        if _is_transaction_row(has_date, has_amount_cell, texts):
+            return True
+    return False
+
+
+def _select_sheets(sheets, has_transactions):
+    """Keep only sheets that look like transaction lists, or all sheets if none do."""
+    if len(sheets) <= 1:
+        return sheets
+    return [sheet for sheet in sheets if has_transactions(sheet)] or sheets
+
+
+def _parse_xls_legacy(file_bytes):
     """Parse old-format .xls (BIFF) using xlrd."""
-    wb = xlrd.open_workbook(path)
+    wb = xlrd.open_workbook(file_contents=file_bytes)
     lines = []
-    for sheet in wb.sheets():
+    for sheet in _select_sheets(wb.sheets(), _xls_sheet_has_transactions):
         for row_idx in range(sheet.nrows):
-            cells = [str(sheet.cell_value(row_idx, col)) for col in range(sheet.ncols)]
+            cells = [str(c) for c in sheet.row_values(row_idx)]
             if not any(cells):
                 continue
             lines.append(" | ".join(cells))
     return "\n".join(lines)
 
 
-def _parse_xlsx(path):
+def _parse_xlsx(file_bytes):
     """Parse .xlsx using openpyxl."""
-    wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    wb = openpyxl.load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
     lines = []
-    for sheet in wb.worksheets:
+    for sheet in _select_sheets(wb.worksheets, _xlsx_sheet_has_transactions):
         for row in sheet.iter_rows(values_only=True):
             cells = [str(c) if c is not None else "" for c in row]
             if not any(cells):
@@ -153,41 +353,82 @@ def _parse_xlsx(path):
 
 # ── OpenAI ────────────────────────────────────────────────────────────
 
+OPENAI_MODEL = "gpt-4o-mini"
+
+_OPENAI = openai.OpenAI(api_key=OPENAI_API_KEY)
+
+# Bump when the prompt, input filtering or response handling changes to invalidate cached extractions
+PROMPT_VERSION = 3
+
+SYSTEM_PROMPT = (
+    "You are a bank statement parser. Extract all transactions "
+    "from the provided bank statement text. Return a JSON object "
+    '{"transactions": [...]} where each transaction is an object '
+    "with these fields:\n"
+    '- "date": transaction date in YYYY-MM-DD format\n'
+    '- "amount": transaction amount as a number (positive for '
+    "credits, negative for debits)\n"
+    '- "counterparty": name of the other party\n'
+    '- "description": payment description/reference\n'
+    '- "ref": invoice or document reference number if mentioned '
+    "(e.g. invoice number, contract number), otherwise empty string\n\n"
+    "Return ONLY the JSON object, no other text."
+)
+
+
+# Dates, with an optional time as rendered from spreadsheet datetimes (2025-01-03 00:00:00)
+def filter_transaction_lines(statement_text):
+    """Keep only lines that look like transactions (a date and an amount), plus one
+    line of context on each side for headers and wrapped descriptions.
+
+    Returns the text unchanged if no line looks like a transaction, or if
+    fewer than half of the lines with a date would be kept.
+    """
+    lines = statement_text.splitlines()
+    keep = set()
+    date_lines = tx_lines = 0
+    for i, line in enumerate(lines):
+        if not _DATE_RE.search(line):
+            continue
+        date_lines += 1
+        if has_amount(line):
+            tx_lines += 1
+            keep.update((i - 1, i, i + 1))
+    if not keep or tx_lines * 2 < date_lines:
+        return statement_text
+    return "\n".join(line for i, line in enumerate(lines) if i in keep)
+
+
 def extract_transactions(statement_text):
-    """Send statement text to OpenAI, get structured transaction list."""
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
+    """Send statement text to OpenAI, get structured transaction list.
+
+    Non-transaction lines are dropped before sending. Responses are cached
+    by content hash, so identical statement text is only sent to OpenAI once.
+    """
+    statement_text = filter_transaction_lines(statement_text)
+    key = hashlib.sha256(f"{OPENAI_MODEL}\0{SYSTEM_PROMPT}\0{statement_text}".encode()).hexdigest()
+    path = OPENAI_CACHE_DIR / f"{key}.json"
+    if path.exists():
+        cached = orjson.loads(path.read_bytes())
+        if cached.get("prompt_version") == PROMPT_VERSION:
+            return cached["transactions"]
 
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
+    response = _OPENAI.chat.completions.create(
+        model=OPENAI_MODEL,
         messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are a bank statement parser. Extract all transactions "
-                    "from the provided bank statement text. Return a JSON array "
-                    "of objects with these fields:\n"
-                    '- "date": transaction date in YYYY-MM-DD format\n'
-                    '- "amount": transaction amount as a number (positive for '
-                    "credits, negative for debits)\n"
-                    '- "counterparty": name of the other party\n'
-                    '- "description": payment description/reference\n'
-                    '- "ref": invoice or document reference number if mentioned '
-                    "(e.g. invoice number, contract number), otherwise empty string\n\n"
-                    "Return ONLY the JSON array, no other text."
-                ),
-            },
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": statement_text},
         ],
         temperature=0,
+        response_format={"type": "json_object"},
     )
 
-    text = response.choices[0].message.content.strip()
-    # Strip markdown code fence if present
-    if text.startswith("```"):
-        text = text.split("\n", 1)[1]
-        text = text.rsplit("```", 1)[0]
-
-    return json.loads(text)
+    transactions = orjson.loads(response.choices[0].message.content)["transactions"]
+    write_atomic(path, orjson.dumps(
+        {"prompt_version": PROMPT_VERSION, "transactions": transactions},
+        option=orjson.OPT_INDENT_2,
+    ))
+    return transactions
 
 
 # ── Cache ─────────────────────────────────────────────────────────────
@@ -199,92 +440,280 @@ def cache_path(year, month):
 def load_cache(year, month):
     path = cache_path(year, month)
     if path.exists():
-        return json.loads(path.read_text())
+        return orjson.loads(path.read_bytes())
     return {"statements": {}}
 
 
+def write_atomic(path, data):
+    """Write bytes via a per-thread temp file and rename, so readers never see a partial file."""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
 def save_cache(year, month, data):
-    path = cache_path(year, month)
-    path.write_text(json.dumps(data, indent=2, ensure_ascii=False))
+    """Write the month cache atomically, so a crash mid-write keeps the previous file."""
+    write_atomic(cache_path(year, month), orjson.dumps(data, option=orjson.OPT_INDENT_2))
+
+
+def prune_search_cache():
+    """Delete search cache entries (and stray temp files) older than SEARCH_CACHE_TTL."""
+    cutoff = time.time() - SEARCH_CACHE_TTL
+    for path in SEARCH_CACHE_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:
+            pass
 
 
 # ── Matching ──────────────────────────────────────────────────────────
 
+# Invoice-like patterns in transaction descriptions: DH-202512-10218, INV-2025-042, Nr. 123, etc.
+_REF_PATTERNS = [
+    re.compile(r"[A-Z]{2,}-\d[\d-]+\d"),       # DH-202512-10218, INV-2025-042
+    re.compile(r"[Nn]r\.?\s*(\S+)"),            # Nr. 12345 or nr 12345
+    re.compile(r"[Rr]ēķin\S*\s+\S*\s*(\S+)"),  # rēķins/rēķinu Nr ...
+]
+
+# Refs shorter than this, or without a letter or separator, match far too many documents
+MIN_REF_LENGTH = 4
+_REF_SIGNAL_RE = re.compile(r"[^\W\d_]|[-/.]")
+
+# Max pages (of 500 documents) fetched for the batched reference search
+REF_SEARCH_MAX_PAGES = 4
+
+
 def extract_refs(tx):
     """Extract searchable references from transaction description and ref field."""
+    return list(_extract_refs(tx.get("ref", ""), tx.get("description", "")))
+
+
+@functools.lru_cache(maxsize=4096)
+def _extract_refs(ref, desc):
     refs = []
-    ref = tx.get("ref", "")
     if ref:
         refs.append(ref)
 
-    desc = tx.get("description", "")
-    # Look for invoice-like patterns: DH-202512-10218, INV-2025-042, Nr. 123, etc.
-    patterns = [
-        r"[A-Z]{2,}-\d[\d-]+\d",       # DH-202512-10218, INV-2025-042
-        r"[Nn]r\.?\s*(\S+)",            # Nr. 12345 or nr 12345
-        r"[Rr]ēķin\S*\s+\S*\s*(\S+)",  # rēķins/rēķinu Nr ...
-    ]
-    for pat in patterns:
-        for m in re.finditer(pat, desc):
+    for pat in _REF_PATTERNS:
+        for m in pat.finditer(desc):
             refs.append(m.group(0) if not m.groups() else m.group(1))
 
-    return refs
-
+    return tuple(r for r in refs if len(r) >= MIN_REF_LENGTH and _REF_SIGNAL_RE.search(r))
 
-def find_non_statement(results):
-    """Return first result that is not a bank statement."""
-    for doc in results:
-        if BANK_STATEMENT_TAG_ID in doc.get("tags", []):
-            continue
-        return doc
-    return None
 
+def date_window(tx_date, before, after):
+    """Return (date_from, date_to) ISO strings around tx_date, or (None, None) if unparseable."""
+    try:
+        d = date.fromisoformat(tx_date)
+    except ValueError:
+        return None, None
+    return (d - timedelta(days=before)).isoformat(), (d + timedelta(days=after)).isoformat()
 
-def match_transaction(tx):
-    """Try to find a document in Paperless that matches this transaction."""
-    tx_date = tx["date"]
-    counterparty = tx["counterparty"]
-    abs_amount = f"{abs(tx['amount']):.2f}"
 
+def match_window(tx):
+    """Date range in which a matching document for this transaction may be created."""
     # Credits (incoming payments) are usually for invoices from previous months
     is_credit = tx["amount"] > 0
     lookback = 365 if is_credit else 30
+    return date_window(tx["date"], lookback, 14)
+
+
+def in_window(doc, date_from, date_to):
+    """Check whether the document's created date falls within [date_from, date_to]."""
+    if not date_from:
+        return True
+    created = doc.get("created", "")[:10]
+    return date_from <= created <= date_to
+
+
+def statements_window(transactions):
+    """Union of the match windows of all transactions, as (date_from, date_to)."""
+    windows = [match_window(tx) for tx in transactions]
+    starts = [w[0] for w in windows if w[0]]
+    ends = [w[1] for w in windows if w[1]]
+    return (min(starts) if starts else None), (max(ends) if ends else None)
+
+
+def quote_term(term):
+    """Quote terms with punctuation or spaces so Paperless searches them as one phrase."""
+    term = term.replace('"', "")
+    if re.fullmatch(r"\w+", term):
+        return term
+    return f'"{term}"'
+
+
+async def search_refs(session, transactions):
+    """Search the references of all transactions in one search of up to REF_SEARCH_MAX_PAGES pages.
+
+    Returns {ref: [docs containing it]}.
+    """
+    tx_refs = [extract_refs(tx) for tx in transactions]
+    refs = sorted({ref for refs in tx_refs for ref in refs})
+    if not refs:
+        return {}
+
+    date_from, date_to = statements_window(transactions)
+    query = " OR ".join(quote_term(ref) for ref in refs)
+    results = await search_documents(session, query, date_from, date_to, page_size=500, max_pages=REF_SEARCH_MAX_PAGES)
+
+    # A ref matches a document when its tokens appear as a phrase, as in the search itself,
+    # so that "12" does not match inside dates or amounts
+    ref_tokens = {ref: tokenize(ref) for ref in refs}
+    index = {}
+    for doc in results:
+        doc_tokens = tokenize(f"{doc.get('title', '')}\n{doc.get('content', '')}")
+        for ref, tokens in ref_tokens.items():
+            if tokens.strip() and tokens in doc_tokens:
+                index.setdefault(ref, []).append(doc)
+    return index
 
-    try:
-        d = date.fromisoformat(tx_date)
-        date_from = (d - timedelta(days=lookback)).isoformat()
-        date_to = (d + timedelta(days=14)).isoformat()
-    except ValueError:
-        date_from = date_to = None
 
-    # 1. Search by reference numbers (most precise)
+# Same word tokens as the Paperless (Whoosh) full-text index: dotted runs like 12.01.2025 stay whole
+_TOKEN_RE = re.compile(r"\w+(?:\.?\w+)*")
+
+
+def tokenize(text):
+    """Lowercased index tokens of text, space-joined and padded for phrase lookups."""
+    return " " + " ".join(_TOKEN_RE.findall(text.lower())) + " "
+
+
+# Amounts as printed on invoices: 45.00, 1234.56, 1 234,56, 1.234.567,89
+_DOC_AMT_RE = re.compile(r"(?<![\d.,])(?:\d{1,3}(?:[ .,\u00a0]\d{3})+|\d+)[.,]\d{2}(?![.,]?\d)")
+
+
+def index_by_amount(docs):
+    """Index documents by every amount in their content, normalized like 1234.56."""
+    by_amount = defaultdict(list)
+    for doc in docs:
+        amounts = set()
+        for m in _DOC_AMT_RE.finditer(doc.get("content", "")):
+            amounts.add(re.sub(r"[ .,\u00a0]", "", m.group(0)[:-3]) + "." + m.group(0)[-2:])
+        for amount in amounts:
+            by_amount[amount].append(doc)
+    return by_amount
+
+
+# Legal-form words that appear in most company names and say nothing about which company it is
+_LEGAL_FORMS = {
+    "sia", "as", "ik", "uab", "ou", "oü", "ab", "oy", "ltd", "llc", "inc", "plc", "corp",
+    "co", "company", "limited", "gmbh", "ag", "kg", "bv", "nv", "sa", "srl", "spa",
+}
+
+
+def counterparty_key(counterparty):
+    """Most distinctive token of a counterparty name: the longest one that isn't a legal form."""
+    tokens = [
+        t for t in _TOKEN_RE.findall(counterparty.lower())
+        if t not in _LEGAL_FORMS and len(t) >= 3
+    ]
+    return max(tokens, key=len, default=None)
+
+
+def mentions_counterparty(doc, counterparty):
+    """Check whether the counterparty's distinctive token appears as a whole word in the document."""
+    key = counterparty_key(counterparty)
+    if not key:
+        return False
+    return f" {key} " in tokenize(f"{doc.get('title', '')}\n{doc.get('content', '')}")
+
+
+def match_transaction(tx, ref_index, by_amount):
+    """Try to find a document in Paperless that matches this transaction."""
+    abs_amount = f"{abs(tx['amount']):.2f}"
+    date_from, date_to = match_window(tx)
+
+    # 1. Match by reference numbers (most precise), resolved from the statement-wide search
     for ref in extract_refs(tx):
-        results = search_documents(ref, date_from, date_to)
-        doc = find_non_statement(results)
-        if doc:
+        for doc in ref_index.get(ref, []):
+            if in_window(doc, date_from, date_to):
+                return doc
+
+    candidates = by_amount.get(abs_amount, [])
+
+    # 2. Match by counterparty + amount
+    for doc in candidates:
+        if in_window(doc, date_from, date_to) and mentions_counterparty(doc, tx["counterparty"]):
             return doc
 
-    # 2. Search by counterparty + amount
-    results = search_documents(f"{counterparty} {abs_amount}", date_from, date_to)
-    doc = find_non_statement(results)
-    if doc:
-        return doc
+    # 3. Match by amount only (last resort, narrow date range)
+    narrow_from, narrow_to = date_window(tx["date"], 5, 5)
+    for doc in candidates:
+        if in_window(doc, narrow_from, narrow_to):
+            return doc
+
+    return None
+
+
+def candidate_window(year, month):
+    """Date range of local match candidates for a month: 30 days before to 14 days after."""
+    first_day, next_month = month_bounds(year, month)
+    return (
+        (first_day - timedelta(days=30)).isoformat(),
+        (next_month - timedelta(days=1) + timedelta(days=14)).isoformat(),
+    )
+
+
+_candidates_lock = threading.Lock()
 
-    # 3. Search by amount only (last resort, narrow date range)
-    try:
-        d = date.fromisoformat(tx_date)
-        narrow_from = (d - timedelta(days=5)).isoformat()
-        narrow_to = (d + timedelta(days=5)).isoformat()
-    except ValueError:
-        narrow_from = narrow_to = None
-    results = search_documents(abs_amount, narrow_from, narrow_to)
-    doc = find_non_statement(results)
-    if doc:
-        return doc
 
+@functools.lru_cache(maxsize=None)
+def _candidate_index(year, month):
+    async def fetch():
+        async with paperless_session() as session:
+            return await fetch_candidates(session, *candidate_window(year, month))
+
+    return index_by_amount(asyncio.run(fetch()))
+
+
+def candidate_index(year, month):
+    """Amount index of the month's candidate documents, fetched once per month and shared."""
+    with _candidates_lock:
+        return _candidate_index(year, month)
+
+
+async def search_credit(session, tx, before):
+    """Counterparty + amount search for a credit's invoice older than the candidate window."""
+    key = counterparty_key(tx["counterparty"])
+    if not key:
+        return None
+    abs_amount = f"{abs(tx['amount']):.2f}"
+    date_from, _ = match_window(tx)
+    if not date_from or date_from >= before:
+        return None
+
+    query = f"{quote_term(key)} {quote_term(abs_amount)}"
+    results = await search_documents(session, query, date_from, before)
+    by_amount = index_by_amount(results)
+    for doc in by_amount.get(abs_amount, []):
+        if mentions_counterparty(doc, tx["counterparty"]):
+            return doc
     return None
 
 
+async def match_transactions(transactions, by_amount, candidates_from):
+    """Match transactions against Paperless. Returns matched docs (or None) in input order.
+
+    References are resolved from one search, counterparty/amount against
+    the month's candidate index (covering candidates_from onwards). Credits
+    left unmatched get one search for invoices older than that.
+    """
+    async with paperless_session() as session:
+        ref_index = await search_refs(session, transactions)
+        matches = [match_transaction(tx, ref_index, by_amount) for tx in transactions]
+
+        credits = [
+            i for i, (tx, match) in enumerate(zip(transactions, matches))
+            if match is None and tx["amount"] > 0
+        ]
+        found = await asyncio.gather(
+            *[search_credit(session, transactions[i], candidates_from) for i in credits]
+        )
+        for i, doc in zip(credits, found):
+            matches[i] = doc
+    return matches
+
+
 # ── Notes ─────────────────────────────────────────────────────────
 
 AUDIT_NOTE_PREFIX = "[AUDIT]"
@@ -312,7 +741,10 @@ def format_tx_block(tx, symbol):
 
 
 def write_audit_note(doc_id, transactions):
-    """Write or update the audit note on a statement document."""
+    """Write or update the audit note on a statement document.
+
+    Returns False if the existing note already has the same text.
+    """
     missing = [tx for tx in transactions if not tx.get("matched_doc_id")]
     matched = [tx for tx in transactions if tx.get("matched_doc_id")]
     total = len(transactions)
@@ -331,24 +763,116 @@ def write_audit_note(doc_id, transactions):
 
     note_text = "\n\n".join(parts)
 
-    # Delete old audit note if exists
-    old_id, _ = get_existing_audit_note(doc_id)
+    # Delete old audit note if exists, leave it alone if nothing changed
+    old_id, old_text = get_existing_audit_note(doc_id)
+    if old_text == note_text:
+        return False
     if old_id:
-        requests.delete(
-            f"{PAPERLESS_URL}/api/documents/{doc_id}/notes/?id={old_id}",
-            headers=HEADERS,
-        )
+        SESSION.delete(f"{PAPERLESS_URL}/api/documents/{doc_id}/notes/?id={old_id}")
 
     # Create new note
-    requests.post(
-        f"{PAPERLESS_URL}/api/documents/{doc_id}/notes/",
-        headers=HEADERS,
-        json={"note": note_text},
-    )
+    SESSION.post(f"{PAPERLESS_URL}/api/documents/{doc_id}/notes/", json={"note": note_text})
+    return True
 
 
 # ── Main ──────────────────────────────────────────────────────────────
 
+def extract_statement(stmt, year, month, cache, cache_lock):
+    """Get a statement's transactions, from the month cache or via OpenAI.
+
+    Returns (transactions or None if skipped, output lines). Access to the
+    shared month cache is guarded by cache_lock; the cache is saved right
+    after extraction so an interrupted run keeps its progress.
+    """
+    out = []
+    doc_id = str(stmt["id"])
+    title = stmt.get("title", f"Document #{doc_id}")
+    out.append(f"── {title} (#{doc_id}) ──")
+
+    # Check if transactions already extracted (cached)
+    with cache_lock:
+        cached = cache["statements"].get(doc_id)
+    if cached:
+        transactions = cached["transactions"]
+        out.append(f"  Using cached transactions ({len(transactions)} items)")
+    else:
+        # Try to download original and parse as XLS
+        out.append("  Downloading original from Paperless...")
+        content = None
+        try:
+            file_bytes, filename = download_original(stmt["id"])
+            content = parse_xls_to_text(file_bytes, filename)
+            if content:
+                out.append(f"  Parsed XLS: {filename}")
+        except Exception as e:
+            out.append(f"  Could not download original: {e}")
+
+        # Fallback to OCR text content
+        if not content:
+            out.append("  Using OCR text content...")
+            content = stmt.get("content", "")
+
+        if not content or not content.strip():
+            out.append("  WARNING: Empty document content, skipping")
+            return None, out
+
+        out.append("  Extracting transactions via OpenAI...")
+        try:
+            transactions = extract_transactions(content)
+        except Exception as e:
+            out.append(f"  ERROR extracting transactions: {e}")
+            return None, out
+
+        out.append(f"  Found {len(transactions)} transactions")
+        with cache_lock:
+            cache["statements"][doc_id] = {"transactions": transactions}
+            save_cache(year, month, cache)
+
+    return transactions, out
+
+
+def match_statement(stmt, transactions, year, month, cache, cache_lock):
+    """Match a statement's transactions and write its audit note.
+
+    Returns (matched, unmatched, output lines).
+    """
+    out = []
+    doc_id = str(stmt["id"])
+
+    # Match transactions not matched on a previous run, all at once
+    pending = [tx for tx in transactions if not tx.get("matched_doc_id")]
+    matches = []
+    if pending:
+        by_amount = candidate_index(year, month)
+        candidates_from, _ = candidate_window(year, month)
+        matches = asyncio.run(match_transactions(pending, by_amount, candidates_from))
+    with cache_lock:
+        for tx, match in zip(pending, matches):
+            if match:
+                tx["matched_doc_id"] = match["id"]
+                tx["matched_title"] = match.get("title", "")
+        if any(matches):
+            save_cache(year, month, cache)
+
+    matched = unmatched = 0
+    for tx in transactions:
+        if tx.get("matched_doc_id"):
+            matched += 1
+            out.append(f"  ✓ {tx['date']} | {tx['amount']:>10.2f} | {tx['counterparty']:<30} | → #{tx['matched_doc_id']} {tx.get('matched_title', '')}")
+        else:
+            unmatched += 1
+            out.append(f"  ✗ {tx['date']} | {tx['amount']:>10.2f} | {tx['counterparty']:<30} | NOT FOUND")
+
+    # Write note to Paperless
+    if WRITE_NOTES:
+        if write_audit_note(stmt["id"], transactions):
+            out.append(f"  📝 Note updated on #{doc_id}")
+        else:
+            out.append(f"  📝 Note unchanged on #{doc_id}")
+
+    return matched, unmatched, out
+
+
 def main():
     if len(sys.argv) != 3:
         print("Usage: python audit.py YYYY MM")
@@ -369,76 +893,36 @@ def main():
     print(f"Found {len(statements)} statement(s)")
     print()
 
+    prune_search_cache()
     cache = load_cache(year, month)
+    cache_lock = threading.Lock()
     total_matched = 0
     total_unmatched = 0
 
-    for stmt in statements:
-        doc_id = str(stmt["id"])
-        title = stmt.get("title", f"Document #{doc_id}")
-        print(f"── {title} (#{doc_id}) ──")
-
-        # Check if transactions already extracted (cached)
-        if doc_id in cache["statements"]:
-            transactions = cache["statements"][doc_id]["transactions"]
-            print(f"  Using cached transactions ({len(transactions)} items)")
-        else:
-            # Try to download original and parse as XLS
-            print("  Downloading original from Paperless...")
-            content = None
-            try:
-                file_bytes, filename = download_original(stmt["id"])
-                content = parse_xls_to_text(file_bytes, filename)
-                if content:
-                    print(f"  Parsed XLS: {filename}")
-            except Exception as e:
-                print(f"  Could not download original: {e}")
-
-            # Fallback to OCR text content
-            if not content:
-                print("  Using OCR text content...")
-                content = get_document_content(stmt["id"])
-
-            if not content or not content.strip():
-                print("  WARNING: Empty document content, skipping")
-                continue
-
-            print("  Extracting transactions via OpenAI...")
-            try:
-                transactions = extract_transactions(content)
-            except Exception as e:
-                print(f"  ERROR extracting transactions: {e}")
-                continue
-
-            print(f"  Found {len(transactions)} transactions")
-            cache["statements"][doc_id] = {"transactions": transactions}
-
-        # Match each transaction
-        for tx in transactions:
-            # Skip already matched
-            if tx.get("matched_doc_id"):
-                total_matched += 1
-                doc = tx["matched_doc_id"]
-                print(f"  ✓ {tx['date']} | {tx['amount']:>10.2f} | {tx['counterparty']:<30} | → #{doc}")
-                continue
-
-            # Try to match
-            match = match_transaction(tx)
-            if match:
-                tx["matched_doc_id"] = match["id"]
-                tx["matched_title"] = match.get("title", "")
-                total_matched += 1
-                print(f"  ✓ {tx['date']} | {tx['amount']:>10.2f} | {tx['counterparty']:<30} | → #{match['id']} {match.get('title', '')}")
-            else:
-                total_unmatched += 1
-                print(f"  ✗ {tx['date']} | {tx['amount']:>10.2f} | {tx['counterparty']:<30} | NOT FOUND")
-
-        # Write note to Paperless
-        if WRITE_NOTES:
-            write_audit_note(stmt["id"], transactions)
-            print(f"  📝 Note updated on #{doc_id}")
-
-        print()
+    # Statements are independent, so process them in parallel: first extract
+    # transactions with up to OPENAI_CONCURRENCY OpenAI calls in flight, then
+    # match them on STATEMENT_WORKERS. Output is buffered per statement and
+    # printed in order.
+    with ThreadPoolExecutor(max_workers=OPENAI_CONCURRENCY) as pool:
+        extracted = list(pool.map(
+            lambda stmt: extract_statement(stmt, year, month, cache, cache_lock), statements
+        ))
+
+    def match(item):
+        stmt, (transactions, out) = item
+        if transactions is None:
+            return 0, 0, out
+        matched, unmatched, match_out = match_statement(
+            stmt, transactions, year, month, cache, cache_lock
+        )
+        return matched, unmatched, out + match_out
+
+    with ThreadPoolExecutor(max_workers=STATEMENT_WORKERS) as pool:
+        for matched, unmatched, output in pool.map(match, zip(statements, extracted)):
+            total_matched += matched
+            total_unmatched += unmatched
+            print("\n".join(output))
+            print()
 
     # Save cache
     save_cache(year, month, cache)